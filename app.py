@@ -1,15 +1,24 @@
 import os
-import json
-import threading
-import requests
+import csv
+import orjson
+import re
+import time
+import sqlite3
+import asyncio
+import aiohttp
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 from zipfile import ZipFile, ZIP_DEFLATED
-from collections import defaultdict, Counter
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from flask import Flask
-from telegram import Update, InputFile
+from asgiref.wsgi import WsgiToAsgi
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from telegram import Update
+from telegram.error import TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -20,17 +29,222 @@ from telegram.ext import (
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ACCESS_KEY = os.getenv("ACCESS_KEY")
 AUTHORIZED_USERS_FILE = "authorized_users.json"
+CACHE_DB_FILE = "ipfs_cache.db"
+MEMORY_CACHE_SIZE = 10000
+# CIDv0 ("Qm...") and base32 CIDv1 ("b...") name immutable content; anything else
+# may change, so cached entries for it are revalidated with ETag/Last-Modified
+IMMUTABLE_CID = re.compile(r"Qm[1-9A-HJ-NP-Za-km-z]{44}|b[a-z2-7]{58,}")
+# Tokens fetched at once per /analyze. This is network-bound, so it is sized to
+# mask gateway latency rather than to the CPU count; each in-flight fetch is a
+# coroutine costing a few KB, not a thread with its own ~1MB stack.
+FETCH_CONCURRENCY = int(os.getenv("ANALYZE_WORKERS", "128"))
+# Default executor used for file writes, zip compression and the report build
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "32"))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.25
+MAX_BACKOFF = 8
+# Public gateways throttle aggressively: cap concurrent requests per gateway and
+# bench a gateway for a while after repeated consecutive failures
+GATEWAY_CONCURRENCY = 16
+MAX_GATEWAY_FAILURES = 10
+GATEWAY_COOLDOWN = 60
+
+GATEWAYS = [
+    "https://ipfs.io/ipfs/",
+    "https://cloudflare-ipfs.com/ipfs/",
+    "https://gateway.pinata.cloud/ipfs/"
+]
+gateway_semaphores = {gw: asyncio.Semaphore(GATEWAY_CONCURRENCY) for gw in GATEWAYS}
+gateway_failures = Counter()
+gateway_benched_until = {}
+# How often each gateway won a race; used to order gateways on the next run
+gateway_wins = Counter()
+# Gateway fetches currently in progress, keyed by (cid, token_id)
+inflight = {}
+
+# Shared HTTP session, created once the event loop is running
+http_session = None
 
 # Load or initialize authorized users list
 if os.path.exists(AUTHORIZED_USERS_FILE):
-    with open(AUTHORIZED_USERS_FILE, "r") as f:
-        authorized_users = set(json.load(f))
+    with open(AUTHORIZED_USERS_FILE, "rb") as f:
+        authorized_users = set(orjson.loads(f.read()))
 else:
     authorized_users = set()
+auth_save_lock = asyncio.Lock()
+
+# IPFS content is immutable, so fetched metadata is cached forever:
+# a bounded in-process LRU in front of an on-disk SQLite store
+cache_db = sqlite3.connect(CACHE_DB_FILE, check_same_thread=False)
+cache_db.execute("PRAGMA journal_mode=WAL")
+cache_db.execute("PRAGMA synchronous=NORMAL")
+cache_db.execute(
+    "CREATE TABLE IF NOT EXISTS meta(cid TEXT, tid INTEGER, body BLOB, etag TEXT, last_modified TEXT, "
+    "PRIMARY KEY(cid, tid))"
+)
+cache_columns = {row[1] for row in cache_db.execute("PRAGMA table_info(meta)")}
+for column in ("etag", "last_modified"):
+    if column not in cache_columns:
+        cache_db.execute(f"ALTER TABLE meta ADD COLUMN {column} TEXT")
+memory_cache = OrderedDict()
+
+def remember(key, entry):
+    memory_cache[key] = entry
+    memory_cache.move_to_end(key)
+    if len(memory_cache) > MEMORY_CACHE_SIZE:
+        memory_cache.popitem(last=False)
+
+def cache_get(cid, token_id):
+    key = (cid, token_id)
+    if key in memory_cache:
+        memory_cache.move_to_end(key)
+        return memory_cache[key]
+    row = cache_db.execute("SELECT body, etag, last_modified FROM meta WHERE cid=? AND tid=?", key).fetchone()
+    if row is None:
+        return None
+    remember(key, row)
+    return row
+
+def cache_put_many(rows):
+    cache_db.executemany(
+        "INSERT OR REPLACE INTO meta(cid, tid, body, etag, last_modified) VALUES (?, ?, ?, ?, ?)", rows
+    )
+    cache_db.commit()
+
+def write_auth_users(users):
+    # Write to a temp file and swap it in so a crash can't leave a truncated file
+    tmp_file = AUTHORIZED_USERS_FILE + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(orjson.dumps(users))
+    os.replace(tmp_file, AUTHORIZED_USERS_FILE)
+
+async def save_auth_users():
+    async with auth_save_lock:
+        users = list(authorized_users)
+        await asyncio.get_running_loop().run_in_executor(None, write_auth_users, users)
+
+async def open_http_session():
+    global http_session
+    # Keep-alive connections are pooled per gateway host and reused across /analyze calls
+    connector = aiohttp.TCPConnector(
+        limit=FETCH_CONCURRENCY, limit_per_host=32, ttl_dns_cache=300, keepalive_timeout=30
+    )
+    http_session = aiohttp.ClientSession(connector=connector)
+
+async def close_http_session():
+    if http_session is not None:
+        await http_session.close()
+
+def gateway_available(gw):
+    return time.monotonic() >= gateway_benched_until.get(gw, 0)
+
+def record_gateway_result(gw, ok):
+    if ok:
+        gateway_failures[gw] = 0
+        return
+    gateway_failures[gw] += 1
+    if gateway_failures[gw] >= MAX_GATEWAY_FAILURES:
+        gateway_benched_until[gw] = time.monotonic() + GATEWAY_COOLDOWN
+        gateway_failures[gw] = 0
+
+async def get_body(gw, path, timeout, headers=None):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with gateway_semaphores[gw]:
+                async with http_session.get(gw + path, timeout=timeout, headers=headers) as r:
+                    if r.ok:
+                        body = await r.read()
+                        record_gateway_result(gw, True)
+                        return r.status, body, (r.headers.get("ETag"), r.headers.get("Last-Modified"))
+                    status = r.status
+                    retry_after = r.headers.get("Retry-After", "")
+        except Exception:
+            record_gateway_result(gw, False)
+            raise
+        if status not in RETRY_STATUSES:
+            return None
+
+        # Honour Retry-After on 429, otherwise back off exponentially; give up on
+        # this gateway rather than wait longer than MAX_BACKOFF
+        delay = min(MAX_BACKOFF, RETRY_BACKOFF * 2 ** attempt)
+        if status == 429 and retry_after.isdigit():
+            delay = int(retry_after)
+        if attempt == MAX_RETRIES or delay > MAX_BACKOFF:
+            record_gateway_result(gw, False)
+            return None
+        await asyncio.sleep(delay)
+    return None
+
+def valid_attributes(data):
+    attributes = data.get("attributes", [])
+    if isinstance(attributes, dict):
+        return list(attributes.items())
+    return [
+        (attr["trait_type"], attr["value"])
+        for attr in attributes
+        if isinstance(attr, dict) and "trait_type" in attr and "value" in attr
+    ]
+
+# Parses the fetched metadata, scores and ranks every token and writes the CSV.
+# Runs in the executor; returns an error message when there is nothing to report.
+def build_rarity_report(raw_bodies, output_csv):
+    token_ids = []
+    flat_traits_list = []
+    attr_counts = []
+    traits_list = []
+    values_list = []
+    for token_id, body in raw_bodies:
+        try:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            continue
+        if not data:
+            continue
+        attributes = valid_attributes(data)
+        for trait, val in attributes:
+            traits_list.append(trait)
+            values_list.append(val)
+        token_ids.append(token_id)
+        flat_traits_list.append(dict(attributes))
+        attr_counts.append(len(attributes))
 
-def save_auth_users():
-    with open(AUTHORIZED_USERS_FILE, "w") as f:
-        json.dump(list(authorized_users), f)
+    if not token_ids:
+        return "❌ No metadata fetched. Check CID and token range."
+    if not traits_list:
+        return "⚠️ Metadata fetched, but no valid attributes found in any token."
+
+    # Give every (trait, value) pair an integer code, count codes with bincount,
+    # compute rarity = total / frequency once per distinct pair, gather it back per
+    # attribute and sum per token with bincount
+    total_tokens = len(token_ids)
+    pair_codes, _ = pd.factorize(pd.MultiIndex.from_arrays([traits_list, values_list]))
+    pair_rarity = total_tokens / np.bincount(pair_codes)
+    row_idx = np.repeat(np.arange(total_tokens), attr_counts)
+    scores = np.bincount(row_idx, weights=pair_rarity[pair_codes], minlength=total_tokens).round(4)
+
+    # Sort once by descending score; tied scores share the lowest rank (method="min")
+    order = np.argsort(-scores, kind="stable")
+    ranked_scores = scores[order]
+    is_new_score = np.r_[True, ranked_scores[1:] != ranked_scores[:-1]]
+    ranks = np.maximum.accumulate(np.where(is_new_score, np.arange(1, total_tokens + 1), 0))
+
+    # Stream rows in rank order; trait columns keep first-seen order and tokens
+    # missing a trait get an empty cell
+    trait_names = dict.fromkeys(chain.from_iterable(flat_traits_list[i] for i in order))
+    fieldnames = dict.fromkeys(["token_id", "rarity_score", *trait_names, "rarity_rank"])
+    scores = scores.tolist()
+    with open(output_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(fieldnames))
+        writer.writeheader()
+        for i, rank in zip(order.tolist(), ranks.tolist()):
+            writer.writerow({
+                "token_id": token_ids[i],
+                "rarity_score": scores[i],
+                **flat_traits_list[i],
+                "rarity_rank": rank
+            })
+    return None
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("👋 Welcome! Use /auth <key> to access this bot.")
@@ -45,7 +259,7 @@ async def auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     if context.args[0] == ACCESS_KEY:
         authorized_users.add(user_id)
-        save_auth_users()
+        await save_auth_users()
         await update.message.reply_text("✅ Access granted!")
     else:
         await update.message.reply_text("❌ Invalid key.")
@@ -68,93 +282,121 @@ async def analyze(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Start and End IDs must be integers.")
         return
 
-    await update.message.reply_text("🔄 Fetching metadata... Please wait.")
+    progress_msg = await update.message.reply_text("🔄 Fetching metadata... Please wait.")
 
-    gateways = [
-        "https://ipfs.io/ipfs/",
-        "https://cloudflare-ipfs.com/ipfs/",
-        "https://gateway.pinata.cloud/ipfs/"
-    ]
+    gateways = sorted(GATEWAYS, key=lambda gw: gateway_wins[gw], reverse=True)
+    immutable = IMMUTABLE_CID.fullmatch(cid) is not None
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
     base_dir = os.getcwd()
     output_csv = os.path.join(base_dir, f"rarity_report_{timestamp}.csv")
     output_zip = os.path.join(base_dir, f"nft_metadata_{timestamp}.zip")
-    jsons = {}
-    trait_counter = defaultdict(Counter)
+    raw_bodies = []
+    new_cache_rows = []
 
-    def fetch_metadata(token_id):
-        for gw in gateways:
-            for suffix in ["", ".json"]:
-                try:
-                    url = f"{gw}{cid}/{token_id}{suffix}"
-                    r = requests.get(url, timeout=5)
-                    if r.ok:
-                        return token_id, r.json()
-                except:
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=5)
+
+    async def fetch_from_gateway(gw, token_id, cached):
+        headers = {}
+        if cached is not None:
+            _, etag, last_modified = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        for suffix in ["", ".json"]:
+            try:
+                response = await get_body(gw, f"{cid}/{token_id}{suffix}", timeout, headers)
+                if response is None:
                     continue
-        return token_id, None
-
-    with ThreadPoolExecutor(max_workers=32) as executor:
-        tasks = [executor.submit(fetch_metadata, i) for i in range(start, end + 1)]
-        for fut in tqdm(as_completed(tasks), total=len(tasks)):
-            token_id, data = fut.result()
-            if data:
-                jsons[token_id] = data
-                for attr in data.get("attributes", []):
-                    if isinstance(attr, dict) and "trait_type" in attr and "value" in attr:
-                        trait_counter[attr["trait_type"]][attr["value"]] += 1
-
-    if not jsons:
-        await update.message.reply_text("❌ No metadata fetched. Check CID and token range.")
-        return
+                status, body, validators = response
+                if status == 304:
+                    return gw, cached[0], None
+                # Full parsing is deferred; an error page served with a 200 is not JSON
+                if body.lstrip()[:1] == b"{":
+                    return gw, body, validators
+            except Exception:
+                continue
+        return gw, None, None
 
-    has_valid_attributes = any(
-        isinstance(attr, dict) and "trait_type" in attr and "value" in attr
-        for data in jsons.values()
-        for attr in data.get("attributes", [])
-    )
-    if not has_valid_attributes:
-        await update.message.reply_text("⚠️ Metadata fetched, but no valid attributes found in any token.")
-        return
+    async def race_gateways(token_id, cached):
+        # Race all healthy gateways and keep the first usable answer
+        candidates = [gw for gw in gateways if gateway_available(gw)] or gateways
+        async with semaphore:
+            pending = {asyncio.create_task(fetch_from_gateway(gw, token_id, cached)) for gw in candidates}
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        gw, body, validators = task.result()
+                        if body is not None:
+                            gateway_wins[gw] += 1
+                            if validators is not None:
+                                remember((cid, token_id), (body, *validators))
+                                new_cache_rows.append((cid, token_id, body, *validators))
+                            return body
+            finally:
+                for task in pending:
+                    task.cancel()
+        # Serve the stale copy if no gateway could revalidate it
+        return cached[0] if cached is not None else None
+
+    async def fetch_metadata(token_id):
+        cached = cache_get(cid, token_id)
+        if cached is not None and immutable:
+            return token_id, cached[0]
 
-    total_tokens = len(jsons)
-    rarity_data = []
-    for token_id, data in jsons.items():
-        score = 0.0
-        flat_traits = {}
-
-        attributes = data.get("attributes", [])
-        if isinstance(attributes, dict):
-            attributes = [{"trait_type": k, "value": v} for k, v in attributes.items()]
-
-        for attr in attributes:
-            if isinstance(attr, dict) and "trait_type" in attr and "value" in attr:
-                trait = attr["trait_type"]
-                val = attr["value"]
-                freq = trait_counter[trait][val]
-                rarity_score = 1 / (freq / total_tokens)
-                flat_traits[trait] = val
-                score += rarity_score
-        rarity_data.append({
-            "token_id": token_id,
-            "rarity_score": round(score, 4),
-            **flat_traits
-        })
-
-    df = pd.DataFrame(rarity_data)
-    df["rarity_rank"] = df["rarity_score"].rank(ascending=False, method="min").astype(int)
-    df = df.sort_values("rarity_rank")
-    df.to_csv(output_csv, index=False)
-
-    with ZipFile(output_zip, "w", ZIP_DEFLATED) as zipf:
-        for token_id, data in jsons.items():
-            zipf.writestr(f"{token_id}.json", json.dumps(data))
+        # Piggyback on an identical fetch already running for another /analyze
+        key = (cid, token_id)
+        if key in inflight:
+            return token_id, await asyncio.shield(inflight[key])
+
+        fut = asyncio.get_running_loop().create_future()
+        inflight[key] = fut
+        body = None
+        try:
+            body = await race_gateways(token_id, cached)
+        finally:
+            del inflight[key]
+            fut.set_result(body)
+        return token_id, body
+
+    # Raw bodies go straight into the zip and are only parsed once fetching is done.
+    # Level 1 deflate keeps most of the ratio on small JSON files at a fraction of
+    # the CPU, and compression runs in the executor so the event loop stays free.
+    loop = asyncio.get_running_loop()
+    tasks = [fetch_metadata(i) for i in range(start, end + 1)]
+    with ZipFile(output_zip, "w", ZIP_DEFLATED, compresslevel=1) as zipf:
+        # Report progress roughly every 5%, at most once a second
+        total = len(tasks)
+        step = max(1, total // 20)
+        last_edit = time.monotonic()
+        for done, fut in enumerate(asyncio.as_completed(tasks), 1):
+            token_id, body = await fut
+            if done % step == 0 and done < total and time.monotonic() - last_edit >= 1:
+                last_edit = time.monotonic()
+                try:
+                    await progress_msg.edit_text(f"🔄 Fetching metadata... {done}/{total}")
+                except TelegramError:
+                    pass
+            if body is not None:
+                await loop.run_in_executor(None, zipf.writestr, f"{token_id}.json", body)
+                raw_bodies.append((token_id, body))
+    cache_put_many(new_cache_rows)
+
+    error = await loop.run_in_executor(None, build_rarity_report, raw_bodies, output_csv)
+    if error:
+        os.remove(output_zip)
+        await update.message.reply_text(error)
+        return
 
     await update.message.reply_text("✅ Analysis complete. Sending files...")
     with open(output_csv, "rb") as f1, open(output_zip, "rb") as f2:
-        await update.message.reply_document(InputFile(f1, filename=os.path.basename(output_csv)))
-        await update.message.reply_document(InputFile(f2, filename=os.path.basename(output_zip)))
+        await asyncio.gather(
+            update.message.reply_document(document=f1, filename=os.path.basename(output_csv)),
+            update.message.reply_document(document=f2, filename=os.path.basename(output_zip)),
+        )
 
     os.remove(output_csv)
     os.remove(output_zip)
@@ -166,16 +408,33 @@ flask_app = Flask(__name__)
 def home():
     return "✅ NFT Bot is running!"
 
-def run_flask():
-    flask_app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
+# Flask runs under the same event loop as the bot, served as ASGI by hypercorn
+asgi_app = WsgiToAsgi(flask_app)
 
-if __name__ == "__main__":
-    # Start Flask in a background thread
-    threading.Thread(target=run_flask, daemon=True).start()
+async def main():
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE))
 
-    # Create and run Telegram bot
     application = ApplicationBuilder().token(BOT_TOKEN).build()
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("auth", auth))
     application.add_handler(CommandHandler("analyze", analyze))
-    application.run_polling()
+
+    config = Config()
+    config.bind = [f"0.0.0.0:{os.environ.get('PORT', 8080)}"]
+
+    await open_http_session()
+    try:
+        async with application:
+            await application.start()
+            await application.updater.start_polling()
+            try:
+                # Returns on SIGINT/SIGTERM
+                await serve(asgi_app, config)
+            finally:
+                await application.updater.stop()
+                await application.stop()
+    finally:
+        await close_http_session()
+
+if __name__ == "__main__":
+    asyncio.run(main())